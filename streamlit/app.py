@@ -1,6 +1,13 @@
-import json
+import io
+import os
+import re
+import shutil
+import tempfile
 from pathlib import Path
 from datetime import datetime
+import ahocorasick
+import numpy as np
+import orjson
 import pandas as pd
 import streamlit as st
 
@@ -13,17 +20,55 @@ st.set_page_config(page_title="Chase CSV → Monthly Category Table", layout="wi
 def norm(s: str) -> str:
     return " ".join(str(s or "").strip().upper().split())
 
+def norm_column(s: pd.Series) -> pd.Series:
+    # norm() once per distinct value, expanded back through the category codes,
+    # so descriptions and preference keys always normalize the same way
+    c = s.astype("category")
+    normed = pd.Categorical([norm(v) for v in c.cat.categories])
+    codes = normed.codes[c.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=normed.dtype), index=s.index)
+
 IGNORE_SUBSTRINGS = ["PAYMENT THANK YOU - WEB"]
+IGNORE_RE = re.compile("|".join(re.escape(sub) for sub in IGNORE_SUBSTRINGS))
+
+def file_mtime(path: Path) -> int:
+    # Cache key for file-backed loaders so hand edits are picked up too
+    return path.stat().st_mtime_ns
+
+def write_atomic(path: Path, data: bytes):
+    # Write a private temp file next to the target, sync it to disk and swap it
+    # in, so neither a crash nor two sessions saving at once leaves half a file
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if path.exists():
+            shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def dump_json(obj) -> bytes:
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2) + b"\n"
 
 @st.cache_data
-def load_categories():
-    return json.loads(CATS_PATH.read_text(encoding="utf-8"))
+def load_categories(mtime: int):
+    return orjson.loads(CATS_PATH.read_bytes())
+
+def save_categories(cats: list):
+    write_atomic(CATS_PATH, dump_json(cats))
+    load_categories.clear()
 
-def load_prefs():
-    return json.loads(PREFS_PATH.read_text(encoding="utf-8"))
+@st.cache_data
+def load_prefs(mtime: int):
+    return orjson.loads(PREFS_PATH.read_bytes())
 
 def save_prefs(prefs: dict):
-    PREFS_PATH.write_text(json.dumps(prefs, indent=2), encoding="utf-8")
+    write_atomic(PREFS_PATH, dump_json(prefs))
+    load_prefs.clear()
 
 def detect_columns(cols):
     cols = list(cols)
@@ -46,45 +91,97 @@ def detect_columns(cols):
         "type": find(["Type"])
     }
 
-def parse_amount(row, cols):
-    def clean(v):
-        if pd.isna(v) or v == "":
-            return 0.0
-        s = str(v).replace("$","").replace(",","").strip()
-        try:
-            return float(s)
-        except:
-            return 0.0
+def parse_dates(s: pd.Series) -> pd.Series:
+    # One pass with the format inferred from the first value, then parse any
+    # leftovers cell by cell so rows in another format are not dropped
+    dates = pd.to_datetime(s, errors="coerce")
+    retry = dates.isna() & s.notna()
+    if retry.any():
+        dates[retry] = pd.to_datetime(s[retry], format="mixed", errors="coerce")
+    return dates
+
+def parse_amounts(df, cols):
+    def clean(s):
+        if pd.api.types.is_numeric_dtype(s):
+            return s.astype(float).fillna(0.0)
+        s = s.astype(str).str.replace(r"[$,]", "", regex=True).str.strip()
+        return pd.to_numeric(s, errors="coerce").fillna(0.0)
     if cols["amount"]:
-        return clean(row[cols["amount"]])
-    debit = clean(row[cols["debit"]]) if cols["debit"] else 0.0
-    credit = clean(row[cols["credit"]]) if cols["credit"] else 0.0
+        return clean(df[cols["amount"]])
+    debit = clean(df[cols["debit"]]) if cols["debit"] else 0.0
+    credit = clean(df[cols["credit"]]) if cols["credit"] else 0.0
     return credit - debit
 
-def should_ignore(desc, typ, ignore_payments: bool):
-    if not ignore_payments:
-        return False
-    d = norm(desc)
-    if any(sub in d for sub in IGNORE_SUBSTRINGS):
-        return True
-    t = norm(typ)
-    if t and "PAYMENT" in t:
-        return True
-    return False
+def ignore_mask(desc_norm, typ):
+    return desc_norm.str.contains(IGNORE_RE, na=False) | typ.str.upper().str.contains("PAYMENT", regex=False, na=False)
 
 def build_pref_index(prefs: dict):
     exact = {norm(k): v for k, v in prefs.items()}
     contains = sorted([(norm(k), v) for k, v in prefs.items() if len(norm(k)) >= 6], key=lambda x: len(x[0]), reverse=True)
-    return exact, contains
-
-def categorize(desc, exact, contains):
-    d = norm(desc)
-    if d in exact:
-        return exact[d]
-    for k, cat in contains:
-        if k in d:
-            return cat
-    return None
+    if not contains:
+        return exact, None
+    # Values carry the position in the longest-first list, so the lowest hit
+    # is the key the old sorted loop would have picked.
+    automaton = ahocorasick.Automaton()
+    for i, (k, cat) in enumerate(contains):
+        if k not in automaton:
+            automaton.add_word(k, (i, cat))
+    automaton.make_automaton()
+    return exact, automaton
+
+@st.cache_resource(max_entries=1)
+def get_pref_index(prefs_mtime: int):
+    return build_pref_index(load_prefs(prefs_mtime))
+
+def categorize(desc_norms, exact, automaton):
+    # Resolve each distinct description once, then expand through the codes
+    matched = []
+    for d in desc_norms.cat.categories:
+        cat = exact.get(d)
+        if cat is None and automaton is not None:
+            hit = min((v for _, v in automaton.iter(d)), default=None)
+            if hit:
+                cat = hit[1]
+        matched.append(cat)
+    matched = pd.Categorical(matched)
+    codes = matched.codes[desc_norms.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=matched.dtype), index=desc_norms.index)
+
+@st.cache_data(max_entries=1)
+def parse_csv(file_bytes: bytes):
+    header = list(pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns)
+    cols = detect_columns(header)
+    if not cols["date"] or not cols["desc"] or (not cols["amount"] and not (cols["debit"] or cols["credit"])):
+        return None, cols, header
+
+    # Only read the columns we use; text columns go straight to Arrow strings
+    usecols = list(dict.fromkeys(c for c in cols.values() if c))
+    text = {cols[k]: "string[pyarrow]" for k in ("desc", "type") if cols[k]}
+    df = pd.read_csv(io.BytesIO(file_bytes), usecols=usecols, dtype=text)
+
+    parsed = pd.DataFrame({
+        "date": parse_dates(df[cols["date"]]),
+        "description": df[cols["desc"]].fillna(""),
+        "type": df[cols["type"]].fillna("") if cols["type"] else "",
+    })
+
+    parsed["amount"] = parse_amounts(df, cols)
+
+    parsed = parsed[parsed["date"].notna()]
+    parsed["desc_norm"] = norm_column(parsed["description"])
+    parsed = parsed[parsed["desc_norm"] != ""]
+    parsed["year"] = parsed["date"].dt.year
+    parsed["month"] = parsed["date"].dt.month
+    return parsed, cols, header
+
+@st.cache_data(max_entries=1)
+def categorize_csv(file_bytes: bytes, prefs_mtime: int):
+    # Parsing is cached on the file alone, so saving a preference only re-runs categorize
+    parsed, cols, columns = parse_csv(file_bytes)
+    if parsed is not None:
+        exact, automaton = get_pref_index(prefs_mtime)
+        parsed["category"] = categorize(parsed["desc_norm"], exact, automaton)
+    return parsed, cols, columns
 
 st.title("Chase CSV → Monthly Category Table (local autosave)")
 
@@ -93,127 +190,134 @@ with st.sidebar:
     debits_only = st.checkbox("Count spending as debits only", value=True)
     ignore_payments = st.checkbox("Ignore payments like Payment Thank You - Web", value=True)
 
-cats = load_categories()
-prefs = load_prefs()
+cats = load_categories(file_mtime(CATS_PATH))
+prefs = load_prefs(file_mtime(PREFS_PATH))
 
 uploaded = st.file_uploader("Upload Chase CSV", type=["csv"])
 if not uploaded:
     st.info("Upload a CSV to begin.")
     st.stop()
 
-df = pd.read_csv(uploaded)
-cols = detect_columns(df.columns)
+parsed, cols, columns = categorize_csv(uploaded.getvalue(), file_mtime(PREFS_PATH))
 
-if not cols["date"] or not cols["desc"] or (not cols["amount"] and not (cols["debit"] or cols["credit"])):
+if parsed is None:
     st.error("Couldn't detect required columns. Need Date, Description, and Amount (or Debit/Credit).")
-    st.write({"detected": cols, "columns": list(df.columns)})
+    st.write({"detected": cols, "columns": columns})
     st.stop()
 
-# Parse
-exact, contains = build_pref_index(prefs)
-
-def parse_date(x):
-    try:
-        return pd.to_datetime(x)
-    except:
-        return pd.NaT
-
-parsed = pd.DataFrame({
-    "date": df[cols["date"]].apply(parse_date),
-    "description": df[cols["desc"]].astype(str).fillna(""),
-    "type": df[cols["type"]].astype(str).fillna("") if cols["type"] else "",
-})
-
-parsed["amount"] = df.apply(lambda r: parse_amount(r, cols), axis=1)
-
-parsed = parsed[parsed["date"].notna()]
-parsed = parsed[~parsed["description"].str.strip().eq("")]
 # ignore payments
-parsed = parsed[~parsed.apply(lambda r: should_ignore(r["description"], r["type"], ignore_payments), axis=1)]
-
-parsed["category"] = parsed["description"].apply(lambda d: categorize(d, exact, contains))
+if ignore_payments:
+    parsed = parsed[~ignore_mask(parsed["desc_norm"], parsed["type"])]
 
-years = sorted(parsed["date"].dt.year.unique().tolist())
+years = sorted(parsed["year"].unique().tolist())
 year = st.selectbox("Year", years, index=len(years)-1 if years else 0)
 
 # Unmatched
-unmatched = parsed[parsed["category"].isna()].copy()
+unmatched = parsed.loc[parsed["category"].isna(), ["desc_norm", "description", "amount"]]
 st.subheader("Unmatched merchants")
 if unmatched.empty:
     st.success("Everything matched a category for this CSV.")
 else:
-    unmatched["desc_norm"] = unmatched["description"].apply(norm)
-    grp = unmatched.groupby("desc_norm").agg(
+    # estimate spend (debits only or not, credits never count as spend)
+    amt = unmatched["amount"].to_numpy()
+    est_spend = np.where(amt < 0, -amt, 0.0)
+
+    grp = unmatched.assign(est_spend=est_spend).groupby("desc_norm", observed=True).agg(
         example=("description","first"),
         count=("description","size"),
         total_amt=("amount","sum"),
+        est_spend=("est_spend","sum"),
     ).reset_index()
 
-    # estimate spend
-    if debits_only:
-        grp["est_spend"] = unmatched.assign(sp=unmatched["amount"].where(unmatched["amount"] < 0, 0).abs()) \
-            .groupby("desc_norm")["sp"].sum().values
-    else:
-        grp["est_spend"] = unmatched.assign(sp=(-unmatched["amount"]).clip(lower=0)) \
-            .groupby("desc_norm")["sp"].sum().values
-
     grp = grp.sort_values("est_spend", ascending=False)
 
-    for _, row in grp.iterrows():
-        with st.container(border=True):
-            st.write(f"**{row['example']}**  •  {int(row['count'])} tx  •  est. spend: ${row['est_spend']:.2f}")
-            c1, c2, c3 = st.columns([2,2,1])
-            with c1:
-                pick = st.selectbox("Pick category", [""] + cats, key=f"pick_{row['desc_norm']}")
-            with c2:
-                typed = st.text_input("…or type category", value=pick, key=f"type_{row['desc_norm']}")
-            with c3:
-                if st.button("Apply", key=f"apply_{row['desc_norm']}"):
-                    chosen = typed.strip()
-                    if not chosen:
-                        st.warning("Choose or type a category first.")
-                    else:
-                        if chosen not in cats:
-                            cats.append(chosen)
-                            CATS_PATH.write_text(json.dumps(cats, indent=2), encoding="utf-8")
-
-                        prefs[row["example"]] = chosen
-                        save_prefs(prefs)
-                        st.success("Saved to preferences.json — re-run by refreshing the page.")
-                        st.stop()
+    # Picks live in session state: the editor is rebuilt whenever its data or
+    # category options change, and would otherwise drop them. Its category column
+    # is seeded from a snapshot taken only just before such a rebuild; seeding it
+    # from the live picks would change its data, and so its id, on every edit
+    picks = st.session_state.setdefault("category_picks", {})
+    seed = st.session_state.setdefault("category_seed", {})
+
+    def add_category():
+        chosen = st.session_state["new_category"].strip()
+        current = load_categories(file_mtime(CATS_PATH))
+        if not chosen:
+            st.session_state["category_notice"] = ("warning", "Type a category first.")
+        elif chosen in current:
+            st.session_state["category_notice"] = ("warning", f"\"{chosen}\" is already a category.")
+        else:
+            save_categories(current + [chosen])
+            st.session_state["category_seed"] = dict(st.session_state["category_picks"])
+            st.session_state["new_category"] = ""
+            st.session_state["category_notice"] = ("success", f"Added \"{chosen}\".")
+
+    c1, c2 = st.columns([4,1])
+    with c1:
+        st.text_input("Add a new category", key="new_category")
+    with c2:
+        st.button("Add category", on_click=add_category)
+    notice = st.session_state.pop("category_notice", None)
+    if notice:
+        getattr(st, notice[0])(notice[1])
+
+    edited = st.data_editor(
+        grp[["example", "count", "est_spend"]].assign(category=[seed.get(e) for e in grp["example"]]),
+        column_config={
+            "example": st.column_config.TextColumn("Merchant"),
+            "count": st.column_config.NumberColumn("Tx"),
+            "est_spend": st.column_config.NumberColumn("Est. spend", format="$%.2f"),
+            "category": st.column_config.SelectboxColumn("Category", options=cats),
+        },
+        disabled=["example", "count", "est_spend"],
+        hide_index=True,
+        use_container_width=True,
+        key="category_grid",
+    )
+    for example, cat in zip(edited["example"], edited["category"]):
+        if pd.notna(cat) and cat:
+            picks[example] = cat
+        else:
+            picks.pop(example, None)
+
+    if st.button("Apply all"):
+        picked = edited[edited["category"].fillna("") != ""]
+        if picked.empty:
+            st.warning("Choose a category for at least one merchant first.")
+        else:
+            prefs.update(zip(picked["example"], picked["category"]))
+            save_prefs(prefs)
+            for example in picked["example"]:
+                picks.pop(example, None)
+            st.session_state["category_seed"] = dict(picks)
+            st.rerun()
 
 st.divider()
 st.subheader("Monthly spending table")
 
 # Prepare spending
-use = parsed[parsed["date"].dt.year == year].copy()
-
+keep = (parsed["year"] == year) & parsed["category"].notna()
 if debits_only:
-    use = use[use["amount"] < 0].copy()
-    use["spend"] = use["amount"].abs()
-else:
-    use["spend"] = (-use["amount"]).clip(lower=0)
-
-use = use[use["category"].notna()]
-
-use["month"] = use["date"].dt.month
+    keep &= parsed["amount"] < 0
+use = parsed.loc[keep, ["category", "month", "amount"]]
 
-pivot = use.pivot_table(index="category", columns="month", values="spend", aggfunc="sum", fill_value=0.0)
+# debits-only rows are already negative, so negating is enough
+amt = use["amount"].to_numpy()
+spend = pd.Series(np.negative(amt) if debits_only else np.where(amt < 0, -amt, 0.0), index=use.index)
 
-# Ensure all categories appear
-for cat in cats:
-    if cat not in pivot.index:
-        pivot.loc[cat] = 0.0
-pivot = pivot.loc[cats]
+pivot = spend.groupby([use["category"], use["month"]], observed=True).sum().unstack("month", fill_value=0.0)
 
-# Add Total row
-total = pivot.sum(axis=0)
-pivot_out = pd.concat([pd.DataFrame([total], index=["Total"]), pivot], axis=0)
+# Ensure all categories appear, with a Total row on top
+pivot_out = pivot.reindex(["Total"] + cats, fill_value=0.0)
+pivot_out.loc["Total"] = pivot_out.sum(axis=0)
 
 # Rename month numbers to labels
 month_names = {i: datetime(2000, i, 1).strftime("%b") for i in range(1,13)}
 pivot_out = pivot_out.rename(columns=month_names)
 
-st.dataframe(pivot_out.style.format("${:,.2f}"), use_container_width=True)
+st.dataframe(
+    pivot_out,
+    column_config={c: st.column_config.NumberColumn(format="$%.2f") for c in pivot_out.columns},
+    use_container_width=True,
+)
 
-st.caption("Tip: This Streamlit version saves preferences.json to disk when you click Apply.")
+st.caption("Tip: This Streamlit version saves preferences.json to disk when you click Apply all.")